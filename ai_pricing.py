@@ -1,19 +1,35 @@
+import re
 
 # updated 2025-03-08
 
+# (input, output) dollars per million tokens, keyed by model name and its aliases
+_PRICES_PER_MTOK = {
+    # https://platform.openai.com/docs/models#model-endpoint-compatibility
+    ('gpt-4o', 'gpt-4o-2024-08-06', 'gpt-4o-2024-11-20') : (2.5,  10),
+    ('gpt-4o-2024-05-13',)                                : (5,    15),
+    ('gpt-4o-mini', 'gpt-4o-mini-2024-07-18')             : (.15,  .6),
+    ('o3-mini', 'o3-mini-2025-01-31')                     : (1.1,  4.4),
+    ('o1', 'o1-2024-12-17')                               : (15,   60),
+    # https://www.anthropic.com/pricing#anthropic-api
+    ('claude-3-5-sonnet-20241022', 'claude-3-7-sonnet-20250219') : (3, 15),
+}
+
+# flattened to per-token prices so cost() is a single dict lookup and multiply-add
+_PRICES = {model: (inp / 1e6, outp / 1e6)
+           for models, (inp, outp) in _PRICES_PER_MTOK.items()
+           for model in models}
+
+
+# unlisted dated snapshots (e.g. o1-2025-06-01) are priced as their base model, this assumes the
+# snapshot costs the same, so snapshots priced differently (gpt-4o-2024-05-13) must be listed above
+_DATE_SUFFIX = re.compile(r'-\d{4}-\d{2}-\d{2}$')
+
+
 def cost(model, input_tokens, output_tokens):
-    # # https://platform.openai.com/docs/models#model-endpoint-compatibility
-    if model in ['gpt-4o', 'gpt-4o-2024-08-06', 'gpt-4o-2024-11-20']:
-        dollars =  (2.5*input_tokens + 10*output_tokens) / 1e6
-    elif model in ['gpt-4o-mini', 'gpt-4o-mini-2024-07-18']:
-        dollars =  (.15*input_tokens + .6*output_tokens) / 1e6
-    elif model in ['o3-mini', 'o3-mini-2025-01-31']:
-        dollars = (1.1*input_tokens + 4.4*output_tokens) / 1e6
-    elif model in ['o1', 'o1-2024-12-17']:
-        dollars = (15*input_tokens + 60*output_tokens) / 1e6
-    # https://www.anthropic.com/pricing#anthropic-api        
-    elif model in ['claude-3-5-sonnet-20241022', 'claude-3-7-sonnet-20250219']:
-        dollars =  (3*input_tokens + 15*output_tokens) / 1e6
-    else:
-        dollars = -1
-    return dollars
+    p = _PRICES.get(model)
+    if p is None:
+        p = _PRICES.get(_DATE_SUFFIX.sub('', model))
+        if p is None:
+            return -1
+        _PRICES[model] = p   # remember the alias so the next lookup is direct
+    return p[0]*input_tokens + p[1]*output_tokens
@@ -1,10 +1,23 @@
+import asyncio
+import contextlib
+import functools
+import inspect
+import json
+import random
+import time
+from dataclasses import dataclass, asdict
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, TypeVar, Union, overload
+from types import AsyncGeneratorType
 from openai import AsyncOpenAI, RateLimitError, BadRequestError, APIError
 from openai.types import FunctionDefinition
 from openai.types.chat import ChatCompletionToolParam, ChatCompletionMessageParam, ChatCompletionToolMessageParam, ChatCompletionMessageToolCall, ChatCompletionAssistantMessageParam
-from typing import Callable, Optional,  Union
-from types import AsyncGeneratorType
+from openai.types.chat.chat_completion_message_tool_call import Function
 from loguru import logger 
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
+try:
+    import orjson   # faster json serialization when available
+except ImportError:
+    orjson = None
 
 
 client = AsyncOpenAI(max_retries=4)
@@ -47,13 +60,18 @@ ToolFunctionType = Callable[
 
 
 
-class CompletionUsage(BaseModel):
+# CompletionUsage and CompletionLog are internal records created for every completion,
+# so they are plain slotted dataclasses rather than pydantic models to keep them cheap.
+
+@dataclass(slots=True)
+class CompletionUsage:
     """Mimics OpenAI's usage structure"""
     prompt_tokens: int
     completion_tokens: int
 
 
-class CompletionLog(BaseModel):    
+@dataclass(slots=True)
+class CompletionLog:    
     """
     called for every llm chat completion to log inputs, outputs and token usage
     """
@@ -61,52 +79,263 @@ class CompletionLog(BaseModel):
     messages        : list[dict]
     tools           : list[dict]    
     temperature     : float 
+    usage           : Optional[CompletionUsage]   #  prompt_tokens, completion_tokens
     chat_completion : Optional[str] = None
     tool_completion : Optional[list[dict]] = None
-    usage           : CompletionUsage   #  prompt_tokens, completion_tokens
     retry           : Optional[int] = None
     error           : Optional[str] = None
-    
+
+    def __post_init__(self):
+        # shallow copies, the toolchats keep appending to their lists after the log is made
+        self.messages = list(self.messages)
+        self.tools = list(self.tools)
+
+    def to_dict(self) -> dict:
+        """Return the log as a dict"""
+        return {"model"           : self.model,
+                "messages"        : self.messages,
+                "tools"           : self.tools,
+                "temperature"     : self.temperature,
+                "chat_completion" : self.chat_completion,
+                "tool_completion" : self.tool_completion,
+                "usage"           : asdict(self.usage) if self.usage else None,
+                "retry"           : self.retry,
+                "error"           : self.error}
+
+    def to_json(self, indent : Optional[int] = None) -> str:
+        """
+        Serialize the log to json (compact unless an indent is given), dumping any pydantic objects
+        embedded in the messages. Uses orjson when it is available and the indent allows.
+        """
+        if orjson and indent in (None, 2):
+            option = orjson.OPT_INDENT_2 if indent else 0
+            return orjson.dumps(self.to_dict(), default=_json_default, option=option).decode()
+        return json.dumps(self.to_dict(), indent=indent, default=_json_default)
+
+
+def _json_default(obj):
+    """json.dumps fallback for the sdk pydantic objects that end up in messages and toolspecs"""
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump()
+    return str(obj)
+
 # The type of the completion logger function
 # optional function call on for each llm completion to log inputs, outputs and token usage
 CompletionLoggerFunctionType = Callable[[CompletionLog], None]
 
 
-import inspect
+# json schemas are a pure function of the BaseToolParam class and model_json_schema() is slow,
+# so build them once per class and share them across tools (and across the openai/claude toolchats).
+# A plain dict as tool param classes live as long as their modules (first_annotation's cache holds them anyway).
+_SCHEMA_CACHE: dict[type, dict] = {}
+
+def param_json_schema(arg_type : type[BaseToolParam]) -> dict:
+    """
+    Return the (cached) json schema for a BaseToolParam subclass
+    """
+    schema = _SCHEMA_CACHE.get(arg_type)
+    if schema is None:
+        schema = _SCHEMA_CACHE[arg_type] = arg_type.model_json_schema()
+    return schema
+
+@functools.lru_cache(maxsize=None)   # tool functions are long lived module level functions
+def first_annotation(toolfunc : ToolFunctionType) -> Optional[type]:
+    """
+    Return the type annotation of the single argument of a tool function, or None if it takes no arguments
+    """
+    arg_types = [param.annotation for param in inspect.signature(toolfunc).parameters.values()]
+    if len(arg_types) > 1: raise ValueError("Tool function must have no more than one argument")
+    return arg_types[0] if arg_types else None
 
 def toolfunc_to_toolspec(toolfunc : ToolFunctionType) -> ChatCompletionToolParam:
     """
     Convert a list of Tool objects to a list of ChatCompletionToolParam objects
+    The result is cached on the function object as it is relatively expensive to build
     """
+    spec = getattr(toolfunc, "__toolspec_openai__", None)
+    if spec is not None: return spec
     if not toolfunc.__doc__: raise ValueError("Tool function requires a descriptive docstring")
     if not len(toolfunc.__doc__) > 10: raise ValueError("Tool function docstring is too short")    
-    arg_types = [param.annotation for param in inspect.signature(toolfunc).parameters.values()]
-    if len(arg_types) > 1: raise ValueError("Tool function must have no more than one argument")
-    arg_type = arg_types[0] if arg_types else None
+    arg_type = first_annotation(toolfunc)
     if arg_type and not issubclass(arg_type, BaseToolParam): raise ValueError("Tool function argument must be a subclass of BaseToolParam")
-    toolfunc.__setattr__("__param_class__", arg_type)   # save the argument type for later use as it is relatively expensive to inspect  
-    param_json_schema = arg_type.model_json_schema() if arg_type else None
-    return ChatCompletionToolParam( type     = 'function',
+    if not hasattr(toolfunc, "__param_adapter__"):   # already set if the claude toolchat built its spec first
+        toolfunc.__setattr__("__param_class__", arg_type)   # save the argument type for later use as it is relatively expensive to inspect  
+        toolfunc.__setattr__("__param_adapter__", TypeAdapter(arg_type) if arg_type else None)  # prebuilt validator reused for every tool call
+    json_schema = param_json_schema(arg_type) if arg_type else None
+    spec = ChatCompletionToolParam( type     = 'function',
                                     function = FunctionDefinition(  name        = toolfunc.__name__, 
                                                                     description = toolfunc.__doc__,
-                                                                    parameters  = param_json_schema,
+                                                                    parameters  = json_schema,
                                                                     strict      = True))
+    toolfunc.__setattr__("__toolspec_openai__", spec)
+    return spec
+
+
+# tool functions take their own BaseToolParam subclass, so @tool is typed to return the function it is given
+ToolFuncT = TypeVar("ToolFuncT", bound=Callable[..., Any])
+
+@overload
+def tool(toolfunc : ToolFuncT, *, reentrant : bool = True) -> ToolFuncT: ...
+@overload
+def tool(toolfunc : None = None, *, reentrant : bool = True) -> Callable[[ToolFuncT], ToolFuncT]: ...
+
+def tool(toolfunc : Optional[ToolFuncT] = None, *, reentrant : bool = True) -> Union[ToolFuncT, Callable[[ToolFuncT], ToolFuncT]]:
+    """
+    Optional decorator for tool functions that builds the toolspec once at import time
+    instead of on the first toolchat, which also surfaces docstring/argument errors early.
+    The parameter class, validator and json schema it caches are shared with the claude toolchat.
+    Use @tool(reentrant=False) for tools that must not run concurrently with themselves.
+    """
+    def register(toolfunc : ToolFuncT) -> ToolFuncT:
+        toolfunc.__setattr__("__reentrant__", reentrant)
+        toolfunc_to_toolspec(toolfunc)
+        return toolfunc
+    return register(toolfunc) if toolfunc else register
 
     
-def check_duplicate_tools(toolspecs : list[ChatCompletionToolParam]):
-    fnames = [t['function'].name for t in toolspecs]
-    if len(fnames) != len(set(fnames)): 
-        logger.warning(f"Duplicate tool names in toolspecs: {fnames}")
+class TextCoalescer:
+    """
+    Buffers the small text deltas streamed by the model and releases them in batches
+    of at least max_chars characters or after max_delay seconds, to cut down the number
+    of yields (and consumer wakeups / writes) per completion.
+    With enabled=False every delta is released as is.
+    """
+    def __init__(self, max_chars : int = 64, max_delay : float = 0.004, enabled : bool = True):
+        self.max_chars = max_chars if enabled else 0
+        self.max_delay = max_delay
+        self.chunks : list[str] = []
+        self.size = 0
+        self.last_flush = time.monotonic()
+
+    def add(self, text : str) -> Optional[str]:
+        """Add a delta, returning the buffered text if it is due to be released"""
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size >= self.max_chars or time.monotonic() - self.last_flush > self.max_delay:
+            return self.flush()
+        return None
+
+    def poll(self) -> Optional[str]:
+        """Return the buffered text if it has been held for longer than max_delay, call this on every streamed chunk"""
+        if self.chunks and time.monotonic() - self.last_flush > self.max_delay:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        """Return (and clear) any buffered text"""
+        self.last_flush = time.monotonic()
+        if not self.chunks:
+            return None
+        text = "".join(self.chunks)
+        self.chunks.clear()
+        self.size = 0
+        return text
+
+    async def watch(self, stream : AsyncIterator) -> AsyncIterator:
+        """
+        Iterate the stream, yielding None when buffered text is due while waiting on the next chunk,
+        so the caller can flush it rather than hold it for as long as the provider pauses.
+        The next chunk is only awaited with a deadline (through a task) while text is buffered.
+        """
+        it = stream.__aiter__()
+        while True:
+            if not self.chunks:
+                try:
+                    yield await it.__anext__()
+                except StopAsyncIteration:
+                    return
+                continue
+            next_chunk = asyncio.ensure_future(it.__anext__())
+            try:
+                while not next_chunk.done():
+                    if self.chunks:
+                        remaining = self.max_delay - (time.monotonic() - self.last_flush)
+                        await asyncio.wait((next_chunk,), timeout=max(remaining, 0))
+                        if not next_chunk.done():
+                            yield None   # the caller flushes the buffered text
+                    else:
+                        await asyncio.wait((next_chunk,))
+            finally:
+                if not next_chunk.done():   # the stream was abandoned while waiting
+                    next_chunk.cancel()
+            try:
+                yield next_chunk.result()
+            except StopAsyncIteration:
+                return
+
+
+def retry_delay(retries : int, e : Exception) -> float:
+    """
+    Seconds to wait before retrying a failed completion: the Retry-After header of the error response
+    if there is one, otherwise exponential backoff with jitter. Capped at 30 seconds.
+    """
+    response = getattr(e, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(30.0, float(retry_after))
+        except ValueError:
+            pass   # an HTTP date rather than seconds
+    return min(30.0, (2 ** retries) * 0.5 + random.random() * 0.25)
+
+
+def start_tool_call(coro : Awaitable, queue : asyncio.Queue) -> asyncio.Task:
+    """
+    Start a tool call coroutine as a task that puts None on the queue when it is done (successfully or not)
+    """
+    async def run():
+        try:
+            return await coro
+        finally:
+            queue.put_nowait(None)
+    return asyncio.create_task(run())
+
+
+async def merge_tool_messages(tasks : list[asyncio.Task], queue : asyncio.Queue):
+    """
+    Yield the ToolMessages that concurrently running tool call tasks (see start_tool_call) put on the queue
+    as they arrive, until all of the tasks are done. Exceptions raised by the tool calls are re-raised here.
+    """
+    try:
+        pending = len(tasks)
+        while pending:
+            msg = await queue.get()
+            if msg is None:
+                pending -= 1
+            else:
+                yield msg
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()   # no-op for finished tasks, stops any stragglers if the consumer goes away
+
+
+def check_duplicate_tools(toolspecs : list[ChatCompletionToolParam]) -> set[str]:
+    """
+    Log a warning for any duplicate tool names in the toolspecs, returns the set of tool names
+    """
+    fnames = set()
+    for t in toolspecs:
+        fname = t['function'].name
+        if fname in fnames:
+            logger.warning(f"Duplicate tool name in toolspecs: {fname}")
+        fnames.add(fname)
+    return fnames
 
 
     
 async def toolchat(messages : list[ChatCompletionMessageParam],    # note: openai defines these input messages as typed dicts, not pydantic models
                    tools    : list[ToolFunctionType], 
                    model    : str,
-                   log_func : Optional[CompletionLoggerFunctionType] = None):
+                   log_func : Optional[CompletionLoggerFunctionType] = None,
+                   coalesce : bool = True,
+                   coalesce_chars : int = 64,
+                   coalesce_delay : float = 0.004):
     """
     A streaming chat completion function that supports tool calls
     Emits a stream of chat completion messages to the user while internally handling tool calls.
+    Small streamed deltas are coalesced into chunks of coalesce_chars characters or coalesce_delay seconds,
+    use coalesce=False to get every delta as streamed by the model.
     Note that the tool calls and tool responses are not exposed to the user.
     This means the subsequent user message context does not include the tool calls or tool responses, they
     are only visible within this loop (and in the logs if a log_func is provided). 
@@ -114,7 +343,11 @@ async def toolchat(messages : list[ChatCompletionMessageParam],    # note: opena
     # https://github.com/Azure-Samples/azureai-assistant-tool/blob/7e4ec6fedfd165cd42273bc927329dab5aa4a22c/sdk/azure-ai-assistant/azure/ai/assistant/management/chat_assistant_client.py#L312   
     """                   
     # convert our ToolFunctionsbjects to oai ChatCompletionToolParam objects
-    toolspec = [toolfunc_to_toolspec(tool) for tool in tools]
+    base_toolspec = [toolfunc_to_toolspec(tool) for tool in tools]
+    base_toolspec_names = check_duplicate_tools(base_toolspec)  # log warning if there are duplicate tool names in the toolspec
+    toolspec = list(base_toolspec)
+    base_tool_by_name = {tool.__name__: tool for tool in tools}   # lookup for the tool calls requested by the model
+    tool_by_name = base_tool_by_name
     
     # we support maximum of 3 retries on error but note that we loop through here multiple times if there are tool calls to process
     # so that after each tool call the model has an opportunity to process the tool outputs and send response messages to the user.
@@ -124,11 +357,12 @@ async def toolchat(messages : list[ChatCompletionMessageParam],    # note: opena
         loops += 1
         if loops > 20:  raise ValueError("Too many loops")
         if retries > 5: raise ValueError("Too many retries")
-        check_duplicate_tools(toolspec)  # log warning if there are duplicate tool names in the toolspec
         
         # these are the outputs we accumulate via streaming
-        tool_calls = []
-        chat_response_content = ""
+        # text is accumulated as lists of chunks and joined once the stream is done
+        tool_call_chunks : dict[int, dict[str, list[str]]] = {}   # streamed tool call id/name/arguments chunks by tool call index
+        chat_chunks : list[str] = []
+        coalescer = TextCoalescer(coalesce_chars, coalesce_delay, coalesce)
         usage = None
         
         try:            
@@ -137,33 +371,63 @@ async def toolchat(messages : list[ChatCompletionMessageParam],    # note: opena
                                                           tools=toolspec, 
                                                           stream=True, 
                                                           stream_options={"include_usage": True})                                                        
-            async for chunk in stream:       
-                delta = chunk.choices[0].delta if chunk.choices else None
-                if chunk.usage:             
-                    usage = CompletionUsage(prompt_tokens=chunk.usage.prompt_tokens, 
-                                            completion_tokens=chunk.usage.completion_tokens)
-                if delta and delta.content:
-                    chat_response_content += delta.content
-                    yield delta.content
-                if delta and delta.tool_calls:
-                    for tcchunk in delta.tool_calls:
-                        while len(tool_calls) <= tcchunk.index:
-                            tool_calls.append({"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
-                        tc = tool_calls[tcchunk.index]
-                        tc["id"] += tcchunk.id or ""
-                        tc["function"]["name"] += tcchunk.function.name or ""
-                        tc["function"]["arguments"] += tcchunk.function.arguments or ""
+            async for chunk in coalescer.watch(stream):       
+                if chunk is None:   # buffered text came due during a pause in the stream
+                    text = coalescer.flush()
+                    if text: yield text
+                    continue
+                # each field is loaded once per chunk, this loop runs for every streamed token
+                choices = chunk.choices
+                if not choices:
+                    # with include_usage the usage arrives in a final chunk without choices
+                    chunk_usage = chunk.usage
+                    if chunk_usage:             
+                        usage = CompletionUsage(prompt_tokens=chunk_usage.prompt_tokens, 
+                                                completion_tokens=chunk_usage.completion_tokens)
+                    continue
+                delta = choices[0].delta
+                content = delta.content
+                tcchunks = delta.tool_calls
+                if content:
+                    chat_chunks.append(content)
+                    text = coalescer.add(content)
+                elif tcchunks:
+                    text = coalescer.flush()   # release the text before the tool call arguments stream in
+                else:
+                    text = coalescer.poll()
+                if text: yield text
+                if tcchunks:
+                    for tcchunk in tcchunks:
+                        tcc = tool_call_chunks.get(tcchunk.index)
+                        if tcc is None:
+                            tcc = tool_call_chunks[tcchunk.index] = {"id": [], "name": [], "arguments": []}
+                        if tcchunk.id:
+                            tcc["id"].append(tcchunk.id)
+                        function = tcchunk.function
+                        if function.name:
+                            tcc["name"].append(function.name)
+                        if function.arguments:
+                            tcc["arguments"].append(function.arguments)
+            text = coalescer.flush()
+            if text: yield text
 
         except RateLimitError as e:   
+            delay = retry_delay(retries, e)
             logger.warning(f"OpenAI RateLimitError: {e}")
-            logger.info("Retrying...")
+            logger.info(f"Retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
             retries += 1
             continue            
         except APIError as e: 
             if "invalid_request_error" in str(e):
                 raise e
+            status_code = getattr(e, "status_code", None)
+            if status_code and 400 <= status_code < 500 and status_code not in (408, 409):
+                raise   # client errors other than timeouts/conflicts won't succeed on retry
+            delay = retry_delay(retries, e)
             logger.error(f"OpenAI APIError: {e}")
-            logger.info("Retrying...")
+            logger.info(f"Retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
             retries += 1
             continue
         except BadRequestError as e: # too many token
@@ -188,6 +452,12 @@ async def toolchat(messages : list[ChatCompletionMessageParam],    # note: opena
             logger.exception(e)
             raise
 
+        chat_response_content = "".join(chat_chunks)
+        tool_calls = [{"id": "".join(tcc["id"]), 
+                       "type": "function", 
+                       "function": {"name": "".join(tcc["name"]), "arguments": "".join(tcc["arguments"])}}
+                      for _, tcc in sorted(tool_call_chunks.items())]
+
         # log the results of the completion request 
         if log_func: 
             log_func(CompletionLog(model=model, 
@@ -208,7 +478,12 @@ async def toolchat(messages : list[ChatCompletionMessageParam],    # note: opena
             
         if tool_calls:                
             # convert the tool call dicts to ChatCompletionMessageToolCall objects instead of the dicts we used to extract from the stream
-            tool_calls = [ChatCompletionMessageToolCall(**tc) for tc in tool_calls]            
+            # we assembled these dicts ourselves so skip pydantic validation (the assert is stripped under python -O)
+            assert all(tc["id"] and tc["function"]["name"] for tc in tool_calls), f"Incomplete streamed tool calls: {tool_calls}"
+            tool_calls = [ChatCompletionMessageToolCall.model_construct(id       = tc["id"], 
+                                                                        type     = "function", 
+                                                                        function = Function.model_construct(**tc["function"])) 
+                          for tc in tool_calls]            
             assistant_tool_response_message = ChatCompletionAssistantMessageParam(role="assistant", tool_calls=tool_calls)                        
 
         if chat_response_content:
@@ -226,27 +501,42 @@ async def toolchat(messages : list[ChatCompletionMessageParam],    # note: opena
         ## the results of the tool call are sent to the model as ChatCompletionToolMessageParam objects in our loop for subsequent completions
 
         # reset the toolspec to the original list (e.g. remove any tools that were added by previous tool calls)
-        toolspec = [toolfunc_to_toolspec(tool) for tool in tools]
+        toolspec = list(base_toolspec)
+        toolspec_names = set(base_toolspec_names)
+        # the tools offered in the last completion are callable now, tools yielded by this round's calls
+        # are only callable in the next round, the same lifetime as their toolspec entries
+        round_tool_by_name = tool_by_name
+        tool_by_name = dict(base_tool_by_name)
         
-        yield '\n'   # XXX
-        for tc in tool_calls:
+        # tools that are not reentrant are serialized with a lock for this round of tool calls
+        locks = {name: asyncio.Lock() for name, t in round_tool_by_name.items() if not getattr(t, "__reentrant__", True)}
+
+        async def run_tool_call(tc : ChatCompletionMessageToolCall, queue : asyncio.Queue) -> str:
+            """
+            Run one tool call, putting its ToolMessages on the queue for the user and returning the result for the model
+            """
             # find the function the model tool call is referring to
-            toolfunc = next(t for t in tools if t.__name__ == tc.function.name)
-            param = toolfunc.__param_class__.model_validate_json(tc.function.arguments)
-            stream = toolfunc(param)
+            toolfunc = round_tool_by_name[tc.function.name]
+            param = toolfunc.__param_adapter__.validate_json(tc.function.arguments)
             tool_result = ""
             try:
-                async for chunk in stream:
-                    match chunk:        
-                        case ToolMessage():                  
+                async with locks.get(toolfunc.__name__) or contextlib.nullcontext():
+                    async for chunk in toolfunc(param):
+                        # ToolMessage must be checked before str as it is a subclass of str.
+                        # ToolFunctionType is a typing alias that can't be matched against, so check callable()
+                        if isinstance(chunk, ToolMessage):
                             # If the tool function yields a ToolMessage, it is a message to the user, not the model
-                            yield chunk                                                 
-                        case str():   # send the tool result to the model
+                            queue.put_nowait(chunk)
+                        elif isinstance(chunk, str):   # send the tool result to the model
                             tool_result += chunk                                                                  
-                        case ToolFunctionType():  # add tool to toolspec for next completion round
+                        elif callable(chunk):   # add tool to toolspec for next completion round
+                            if chunk.__name__ in toolspec_names:
+                                logger.warning(f"Duplicate tool name in toolspecs: {chunk.__name__}")
+                            toolspec_names.add(chunk.__name__)
                             toolspec.append(toolfunc_to_toolspec(chunk))
+                            tool_by_name.setdefault(chunk.__name__, chunk)   # so the model can call it next round
                             logger.info(f"toolfunc Added tool {chunk.__name__} to toolspec")
-                        case _:
+                        else:
                             logger.error(f"Unexpected chunk type: {type(chunk)}")
                             raise AssertionError(f"Unexpected chunk type: {type(chunk)}")
             except AssertionError as e:
@@ -259,7 +549,16 @@ async def toolchat(messages : list[ChatCompletionMessageParam],    # note: opena
                 # this is a bad, unexpected error in the tool    
                 logger.exception(e) 
                 tool_result = f"Error executing tool '{toolfunc.__name__}': {e}"                
-            messages.append(ChatCompletionToolMessageParam(tool_call_id=tc.id, content=tool_result, role='tool'))   # let the model know what happened                
+            return tool_result
+
+        yield '\n'   # XXX
+        # the tool calls run concurrently so the latency is that of the slowest tool rather than the sum of them
+        queue = asyncio.Queue()
+        tasks = [start_tool_call(run_tool_call(tc, queue), queue) for tc in tool_calls]
+        async for msg in merge_tool_messages(tasks, queue):
+            yield msg
+        for tc, task in zip(tool_calls, tasks):
+            messages.append(ChatCompletionToolMessageParam(tool_call_id=tc.id, content=task.result(), role='tool'))   # let the model know what happened                
         yield '\n'   # XXX
         # continue into while loop for another round of completions
     # end of main while loop
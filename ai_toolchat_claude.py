@@ -1,11 +1,18 @@
 import os
-from anthropic import AsyncAnthropic, NotFoundError, BadRequestError
+import asyncio
+import contextlib
+from anthropic import AsyncAnthropic, NotFoundError, BadRequestError, APIStatusError
 from anthropic.types import ToolUseBlock, ToolResultBlockParam, TextBlock
 from typing import Optional
 from loguru import logger
-import inspect
-import json
-from ai_toolchat import BaseToolParam, ToolMessage, ThinkingMessage, ToolFunctionType, CompletionUsage, CompletionLog, CompletionLoggerFunctionType
+from pydantic import TypeAdapter
+try:
+    import orjson    # faster parsing of the streamed tool input json
+    json_loads = orjson.loads
+except ImportError:
+    import json
+    json_loads = json.loads
+from ai_toolchat import BaseToolParam, first_annotation, param_json_schema, start_tool_call, merge_tool_messages, retry_delay, TextCoalescer, ToolMessage, ThinkingMessage, ToolFunctionType, CompletionUsage, CompletionLog, CompletionLoggerFunctionType
 
 # Initialize client with API key from environment variable
 client = AsyncAnthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
@@ -14,52 +21,137 @@ client = AsyncAnthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
 
 
 def toolfunc_to_toolspec(toolfunc: ToolFunctionType) -> dict:
-    """Convert a tool function to Claude's tool specification format"""
+    """Convert a tool function to Claude's tool specification format (cached on the function object)"""
+    spec = getattr(toolfunc, "__toolspec_claude__", None)
+    if spec is not None:
+        return spec
     if not toolfunc.__doc__:
         raise ValueError("Tool function requires a descriptive docstring")
     if not len(toolfunc.__doc__) > 10:
         raise ValueError("Tool function docstring is too short")
     
-    arg_types = [param.annotation for param in inspect.signature(toolfunc).parameters.values()]
-    if len(arg_types) > 1:
-        raise ValueError("Tool function must have no more than one argument")
-    
-    arg_type = arg_types[0] if arg_types else None
+    arg_type = first_annotation(toolfunc)
     if arg_type and not issubclass(arg_type, BaseToolParam):
         raise ValueError(f"Tool function argument must be a subclass of BaseToolParam (found {arg_type})")
     
-    toolfunc.__setattr__("__param_class__", arg_type)
-    param_json_schema = arg_type.model_json_schema() if arg_type else {}
+    if not hasattr(toolfunc, "__param_adapter__"):   # already set by @tool or the openai toolchat
+        toolfunc.__setattr__("__param_class__", arg_type)
+        toolfunc.__setattr__("__param_adapter__", TypeAdapter(arg_type) if arg_type else None)
+    json_schema = param_json_schema(arg_type) if arg_type else {}
     
-    return {
+    spec = {
         "name": toolfunc.__name__,
         "description": toolfunc.__doc__,
-        "input_schema": param_json_schema
+        "input_schema": json_schema
     }
+    toolfunc.__setattr__("__toolspec_claude__", spec)
+    return spec
+
+
+def check_duplicate_tools(toolspecs: list[dict]) -> set[str]:
+    """
+    Log a warning for any duplicate tool names in the toolspecs, returns the set of tool names
+    """
+    fnames = set()
+    for t in toolspecs:
+        fname = t['name']
+        if fname in fnames:
+            logger.warning(f"Duplicate tool name in toolspecs: {fname}")
+        fnames.add(fname)
+    return fnames
+
+
+
+class StreamState:
+    """
+    The outputs accumulated while processing the events of one streamed completion.
+    Streamed text and tool input json are accumulated as lists of chunks, joined at content_block_stop
+    """
+    __slots__ = ("content_blocks", "content_blocks_text", "content_blocks_json", "coalescer", "usage")
+
+    def __init__(self, coalescer: TextCoalescer):
+        self.content_blocks = []
+        self.content_blocks_text = []
+        self.content_blocks_json = []
+        self.coalescer = coalescer
+        self.usage = CompletionUsage(prompt_tokens=0, completion_tokens=0)
 
 
-def check_duplicate_tools(toolspecs: list[dict]):
-    fnames = [t['name'] for t in toolspecs]
-    if len(fnames) != len(set(fnames)):
-        logger.warning(f"Duplicate tool names in toolspecs: {fnames}")
+# Handlers for each type of stream event, each returns an optional message to yield to the user.
+# Dispatching on event.type avoids probing every event for every attribute it might carry.
 
+def on_message_start(event, state: StreamState):
+    # Message(id='msg_019GZi8kD5Gq8oa5GRosRHrf', content=[], model='claude-3-5-sonnet-20241022', role='assistant', stop_reason=None, stop_sequence=None, type='message', usage=Usage(input_tokens=480, output_tokens=1)
+    state.usage.prompt_tokens += event.message.usage.input_tokens
+
+def on_message_delta(event, state: StreamState):
+    state.usage.completion_tokens += event.usage.output_tokens
+
+def on_content_block_start(event, state: StreamState):
+    state.content_blocks.append(event.content_block)
+    state.content_blocks_text.append([])
+    state.content_blocks_json.append([])
+
+def on_content_block_stop(event, state: StreamState):
+    block = state.content_blocks[event.index]
+    if state.content_blocks_text[event.index]:
+        block.text += "".join(state.content_blocks_text[event.index])
+    input_json = "".join(state.content_blocks_json[event.index])
+    if input_json:
+        # XXX nervous about this loads failing and not having a good feedback mechanism from here
+        block.input = json_loads(input_json)
+    return state.coalescer.flush()
+
+def on_content_block_delta(event, state: StreamState):
+    delta = event.delta
+    dtype = delta.type
+    if dtype == "text_delta":
+        state.content_blocks_text[event.index].append(delta.text)
+        return state.coalescer.add(delta.text)
+    elif dtype == "input_json_delta":
+        state.content_blocks_json[event.index].append(delta.partial_json)
+    elif dtype == "thinking_delta":
+        state.content_blocks[event.index].thinking += delta.thinking
+        return ThinkingMessage(delta.thinking)
+    elif dtype == "signature_delta":
+        state.content_blocks[event.index].signature += delta.signature
+    elif hasattr(delta, 'redacted_thinking'):
+        state.content_blocks[event.index].redacted_thinking += delta.redacted_thinking
+        return ThinkingMessage('redacted-thoughts')
+
+STREAM_EVENT_HANDLERS = {
+    "message_start":       on_message_start,
+    "message_delta":       on_message_delta,
+    "content_block_start": on_content_block_start,
+    "content_block_stop":  on_content_block_stop,
+    "content_block_delta": on_content_block_delta,
+}
 
 
 async def toolchat( messages: list[dict],
                     tools: list[ToolFunctionType],
                     model: str,
                     log_func: Optional[CompletionLoggerFunctionType] = None,
-                    thinking_budget: int = 0):
+                    thinking_budget: int = 0,
+                    coalesce: bool = True,
+                    coalesce_chars: int = 64,
+                    coalesce_delay: float = 0.004):
     """
     A streaming chat completion function that supports tool calls for Claude
     Emits a stream of chat completion messages while handling tool calls internally
+    Small streamed text deltas are coalesced into chunks of coalesce_chars characters or coalesce_delay seconds,
+    use coalesce=False to get every delta as streamed by the model.
     Note that the tool calls and tool responses are not exposed to the user.
     This means the subsequent user message context does not include the tool calls or tool responses, they
     are only visible within this loop (and in the logs if a log_func is provided).     
     """
 
     # convert our ToolFunctions to claude tool specs
-    toolspec = [toolfunc_to_toolspec(tool) for tool in tools]
+    base_toolspec = [toolfunc_to_toolspec(tool) for tool in tools]
+    base_toolspec_names = check_duplicate_tools(base_toolspec)  # log warning if there are duplicate tool names in the toolspec
+    toolspec = list(base_toolspec)
+    base_tool_by_name = {tool.__name__: tool for tool in tools}   # lookup for the tool calls requested by the model
+    tool_by_name = base_tool_by_name
     retries = 0
     loops = 0
 
@@ -79,11 +171,8 @@ async def toolchat( messages: list[dict],
         loops += 1
         if loops > 20:   raise ValueError("Too many loops")
         if retries > 5:  raise ValueError("Too many retries")            
-        check_duplicate_tools(toolspec)
                     
-        content_blocks = []
-        content_blocks_json = []    
-        usage = CompletionUsage(prompt_tokens=0, completion_tokens=0)
+        state = StreamState(TextCoalescer(coalesce_chars, coalesce_delay, coalesce))
         try:
             if thinking:
                 stream = await client.messages.create(  system=system_message,
@@ -102,39 +191,18 @@ async def toolchat( messages: list[dict],
                                                         stream=True)            
             
           
-            async for event in stream:
+            async for event in state.coalescer.watch(stream):
                 #print(event)   # see below for example message stream
-                if event.type == "message_start":
-                    message = event.message 
-                    # Message(id='msg_019GZi8kD5Gq8oa5GRosRHrf', content=[], model='claude-3-5-sonnet-20241022', role='assistant', stop_reason=None, stop_sequence=None, type='message', usage=Usage(input_tokens=480, output_tokens=1)
-                    #logger.info(message)
-                if hasattr(event, 'message'):
-                    if hasattr(event.message, 'usage'):   
-                        usage.prompt_tokens += event.message.usage.input_tokens
-                if hasattr(event, 'usage'):
-                    if hasattr(event.usage, 'output_tokens'):
-                        usage.completion_tokens += event.usage.output_tokens            
-                if event.type == "content_block_start":
-                    content_blocks.append(event.content_block)  
-                    content_blocks_json.append("")
-                if event.type == "content_block_stop":
-                    if content_blocks_json[event.index]:
-                        # XXX nervous about this loads failing and not having a good feedback mechanism from here
-                        content_blocks[event.index].input = json.loads(content_blocks_json[event.index])
-                if event.type == "content_block_delta":
-                    if hasattr(event.delta, 'text'):
-                        content_blocks[event.index].text += event.delta.text
-                        yield event.delta.text
-                    elif hasattr(event.delta, 'thinking'):
-                        content_blocks[event.index].thinking += event.delta.thinking                        
-                        yield ThinkingMessage(event.delta.thinking)
-                    elif hasattr(event.delta, 'signature'):
-                        content_blocks[event.index].signature += event.delta.signature
-                    elif hasattr(event.delta, 'redacted_thinking'):
-                        content_blocks[event.index].redacted_thinking += event.delta.redacted_thinking
-                        yield ThinkingMessage('redacted-thoughts')
-                    elif hasattr(event.delta, 'partial_json'):
-                        content_blocks_json[event.index] += event.delta.partial_json
+                if event is None:   # buffered text came due during a pause in the stream
+                    msg = state.coalescer.flush()
+                else:
+                    handler = STREAM_EVENT_HANDLERS.get(event.type)
+                    msg = handler(event, state) if handler else None
+                if msg:
+                    yield msg
+            text = state.coalescer.flush()
+            if text:
+                yield text
         except (BadRequestError, NotFoundError, TypeError) as e:
             logger.error(f"Error during completion: {e}")
             for m in messages:
@@ -142,9 +210,15 @@ async def toolchat( messages: list[dict],
             raise e
         except Exception as e:
             logger.exception(f"Error during completion: {e}")
+            if isinstance(e, APIStatusError) and 400 <= e.status_code < 500 and e.status_code not in (408, 409, 429):
+                raise   # client errors (auth, permission, validation) won't succeed on retry
+            await asyncio.sleep(retry_delay(retries, e))
             retries += 1
             continue
 
+        content_blocks = state.content_blocks
+        usage = state.usage
+
         # separate out the tool use blocks and text blocks
         tooluseblocks = [b      for b in content_blocks if isinstance(b, ToolUseBlock)]
         textblocks    = [b.text for b in content_blocks if isinstance(b, TextBlock)]      
@@ -168,29 +242,41 @@ async def toolchat( messages: list[dict],
         messages.append({"role": "assistant", "content": [c for c in content_blocks]})
         
         # reset the toolspec to the original list (e.g. remove any tools that were added by previous tool calls)
-        toolspec = [toolfunc_to_toolspec(tool) for tool in tools]      
+        toolspec = list(base_toolspec)      
+        toolspec_names = set(base_toolspec_names)
+        # the tools offered in the last completion are callable now, tools yielded by this round's calls
+        # are only callable in the next round, the same lifetime as their toolspec entries
+        round_tool_by_name = tool_by_name
+        tool_by_name = dict(base_tool_by_name)
         
-        yield '\n'   # XXX
-        toolcontents = []        
-        for tb in tooluseblocks:
+        # tools that are not reentrant are serialized with a lock for this round of tool calls
+        locks = {name: asyncio.Lock() for name, t in round_tool_by_name.items() if not getattr(t, "__reentrant__", True)}
+
+        async def run_tool_call(tb: ToolUseBlock, queue: asyncio.Queue) -> ToolResultBlockParam:
+            """Run one tool call, putting its ToolMessages on the queue for the user and returning the result for the model"""
             is_error = False                            
             # find the function the model tool call is referring to
-            toolfunc = next(t for t in tools if t.__name__ == tb.name)
+            toolfunc = round_tool_by_name[tb.name]
             tool_result = ""          
             try:
-                param = toolfunc.__param_class__.model_validate(tb.input)
-                stream = toolfunc(param)                      
-                async for chunk in stream:
-                    match chunk:        
-                        case ToolMessage():                  
+                param = toolfunc.__param_adapter__.validate_python(tb.input)
+                async with locks.get(toolfunc.__name__) or contextlib.nullcontext():
+                    async for chunk in toolfunc(param):
+                        # ToolMessage must be checked before str as it is a subclass of str.
+                        # ToolFunctionType is a typing alias that can't be matched against, so check callable()
+                        if isinstance(chunk, ToolMessage):
                             # If the tool function yields a ToolMessage, it is a message to the user, not the model
-                            yield chunk                                                 
-                        case str():   # send the tool result to the model
+                            queue.put_nowait(chunk)
+                        elif isinstance(chunk, str):   # send the tool result to the model
                             tool_result += chunk                                                                  
-                        case ToolFunctionType():  # add tool to toolspec for next completion round
+                        elif callable(chunk):   # add tool to toolspec for next completion round
+                            if chunk.__name__ in toolspec_names:
+                                logger.warning(f"Duplicate tool name in toolspecs: {chunk.__name__}")
+                            toolspec_names.add(chunk.__name__)
                             toolspec.append(toolfunc_to_toolspec(chunk))
+                            tool_by_name.setdefault(chunk.__name__, chunk)   # so the model can call it next round
                             #logger.info(f"toolfunc Added tool {chunk.__name__} to toolspec")
-                        case _:
+                        else:
                             logger.error(f"Unexpected chunk type: {type(chunk)}")
                             raise AssertionError(f"Unexpected chunk type: {type(chunk)}")
             except AssertionError as e:
@@ -205,11 +291,18 @@ async def toolchat( messages: list[dict],
                 logger.exception(e) 
                 tool_result = f"Error executing tool '{toolfunc.__name__}': {e}"        
                 is_error = True
-            tresult = ToolResultBlockParam( type        = "tool_result",
-                                            tool_use_id = tb.id, 
-                                            content     = tool_result,
-                                            is_error    = is_error)   
-            toolcontents.append(tresult)     
+            return ToolResultBlockParam(type        = "tool_result",
+                                        tool_use_id = tb.id, 
+                                        content     = tool_result,
+                                        is_error    = is_error)   
+
+        yield '\n'   # XXX
+        # the tool calls run concurrently so the latency is that of the slowest tool rather than the sum of them
+        queue = asyncio.Queue()
+        tasks = [start_tool_call(run_tool_call(tb, queue), queue) for tb in tooluseblocks]
+        async for msg in merge_tool_messages(tasks, queue):
+            yield msg
+        toolcontents = [task.result() for task in tasks]   # in the original tool call order
         messages.append({'role':'user', 'content':toolcontents})
         yield '\n'   # XXX
         # continue into while loop for another round of completions
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 
 import asyncio
-from pydantic import BaseModel, Field
-from typing import Literal
+import atexit
+import sys
+from datetime import datetime, date
+from dataclasses import dataclass, field
+from typing import Literal, Optional
 from prompt_toolkit import PromptSession
 from prompt_toolkit.history import FileHistory
 from prompt_toolkit.formatted_text import FormattedText
@@ -15,21 +18,83 @@ from ai_toolchat import ToolFunctionType, ToolMessage, ThinkingMessage, Completi
 
 MsgRoleType = Literal["system", "user", "assistant"]
 
-class ChatCompletionMessage(BaseModel):
-    role    : MsgRoleType = Field(..., description='The role: system/user/assistant')
-    content : str         = Field(..., description='The content of the message')
+@dataclass(slots=True)
+class ChatCompletionMessage:
+    """
+    A message in the REPL history. These are created locally from trusted strings so they are a
+    plain slotted dataclass rather than a validated pydantic model; the dict sent to the llm is
+    built once at construction.
+    """
+    role    : MsgRoleType   # The role: system/user/assistant
+    content : str           # The content of the message
+    dump    : dict = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.dump = {"role": self.role, "content": self.content}
 
-class UserMessage(ChatCompletionMessage):
-    def __init__(self, content: str):
-        super().__init__(role="user", content=content)
+    @classmethod
+    def user(cls, content: str) -> "ChatCompletionMessage":
+        return cls("user", content)
 
-class SystemMessage(ChatCompletionMessage):
-    def __init__(self, content: str):
-        super().__init__(role="system", content=content)
+    @classmethod
+    def system(cls, content: str) -> "ChatCompletionMessage":
+        return cls("system", content)
 
-class AssistantMessage(ChatCompletionMessage):
-    def __init__(self, content: str):
-        super().__init__(role="assistant", content=content)
+    @classmethod
+    def assistant(cls, content: str) -> "ChatCompletionMessage":
+        return cls("assistant", content)
+
+class TokenSink:
+    """
+    Buffers the streamed output and writes it to stdout in batches, when max_bytes have
+    accumulated, max_delay seconds have passed since the text was buffered, or at the end of a line,
+    rather than issuing a write and flush for every token. Must be written to from the event loop.
+    """
+    def __init__(self, max_bytes: int = 4096, max_delay: float = 0.02):
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.buf = bytearray()
+        self.timer: asyncio.TimerHandle | None = None
+
+    def write(self, txt: str):
+        was_empty = not self.buf
+        self.buf += txt.encode()
+        if len(self.buf) >= self.max_bytes or "\n" in txt:
+            self.flush()
+        elif was_empty:
+            # a timer rather than a check on the next write, so text before a pause in the stream still shows
+            self.timer = asyncio.get_running_loop().call_later(self.max_delay, self.flush)
+
+    def flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.buf:
+            sys.stdout.flush()   # anything already written through sys.stdout goes first
+            sys.stdout.buffer.write(self.buf)
+            sys.stdout.buffer.flush()
+            self.buf.clear()
+
+_system_date : Optional[date] = None
+_system_message : Optional[str] = None
+
+def get_system_message() -> str:
+    """
+    Return the system message, which includes the current date.
+    It is only rebuilt when the UTC date rolls over so long running sessions stay current.
+    """
+    global _system_date, _system_message
+    today = datetime.utcnow().date()
+    message = _system_message
+    if message is None or today != _system_date:
+        message = (
+            "We are assisting the user in a variety of tasks. Use available tools as appropriate. "
+            "Output in markdown format. Use tables for tabular data. "
+            "When using tools, explain to the user what tool you are using and a lay person description of the args. "
+            f"The current date is {today.isoformat()}."
+        )
+        _system_date, _system_message = today, message
+    return message
 
 def choose_toolchat_impl(model_name: str):
     """
@@ -44,21 +109,22 @@ def choose_toolchat_impl(model_name: str):
     else:
         return openai_toolchat
 
-def main(toolfuncs : list[ToolFunctionType]):
-    import sys
-    from datetime import datetime
-    
-    messages = [SystemMessage(
-        "We are assisting the user in a variety of tasks. Use available tools as appropriate. "
-        "Output in markdown format. Use tables for tabular data. "
-        "When using tools, explain to the user what tool you are using and a lay person description of the args. "
-        f"The current date is {datetime.utcnow().strftime('%Y-%m-%d')}."
-    )]
+async def main(toolfuncs : list[ToolFunctionType]):
+    messages = [ChatCompletionMessage.system(get_system_message())]
+    # the messages as dicts for the llm, kept in step with messages so the history is not re-serialized every turn
+    dumped = [m.dump for m in messages]
         
     session_cost = 0
 
+    # completion log opened once for the session, buffered writes are flushed when it is closed at exit
+    log_file = open("completion.log", "a", buffering=65536)
+    atexit.register(log_file.close)
+
     # Default model
     model = "claude-3-7-sonnet-20250219"
+    # resolved once per model change rather than on every turn
+    is_claude = "claude" in model.lower()
+    toolchat_impl = choose_toolchat_impl(model)
     # Default thinking budget (only used with Claude models)
     thinking_budget = 0
     
@@ -66,9 +132,11 @@ def main(toolfuncs : list[ToolFunctionType]):
 
     session = PromptSession(history=FileHistory('.repl_history'))
     
+    # the whole session runs in one event loop, prompting asynchronously so the loop
+    # (and the llm client connection pools) stay alive between turns
     while True:
         try:
-            text = session.prompt('>>> ')
+            text = await session.prompt_async('>>> ')
             if not text:
                 continue
         except KeyboardInterrupt:
@@ -76,11 +144,17 @@ def main(toolfuncs : list[ToolFunctionType]):
         except EOFError:
             break
 
+        # split off a /command and its argument once
+        cmd, _, arg = text.strip().partition(' ')
+        arg = arg.strip()
+
         # Check if user wants to change model
-        if text.startswith('/model '):
-            new_model = text[len('/model '):].strip()
+        if cmd == '/model':
+            new_model = arg
             if new_model:
                 model = new_model
+                is_claude = "claude" in model.lower()
+                toolchat_impl = choose_toolchat_impl(model)
                 print_formatted_text(
                     FormattedText([("fg:green", f"Model changed to: {model}\n")])
                 )
@@ -92,19 +166,13 @@ def main(toolfuncs : list[ToolFunctionType]):
             continue
             
         # Check if user wants to set thinking budget
-        if text.startswith('/thinking'):
+        if cmd == '/thinking':
             try:
-                # Handle both "/thinking" and "/thinking <number>"
-                if text.strip() == '/thinking':
-                    new_budget = 1024  # Minimum budget
-                else:
-                    new_budget = int(text[len('/thinking '):].strip())
-                    # Ensure minimum budget of 1024
-                    if new_budget < 1024:
-                        new_budget = 1024
+                # Handle both "/thinking" and "/thinking <number>", ensuring the minimum budget of 1024
+                new_budget = max(1024, int(arg)) if arg else 1024
                 
                 thinking_budget = new_budget
-                if "claude" in model.lower():
+                if is_claude:
                     print_formatted_text(
                         FormattedText([("fg:green", f"Thinking budget set to: {thinking_budget} tokens\n")])
                     )
@@ -121,8 +189,13 @@ def main(toolfuncs : list[ToolFunctionType]):
             continue
 
         try:
-            user_message = UserMessage(text)
+            user_message = ChatCompletionMessage.user(text)
             messages.append(user_message)
+            dumped.append(user_message.dump)
+            system_message = get_system_message()
+            if messages[0].content != system_message:   # the date rolled over
+                messages[0] = ChatCompletionMessage.system(system_message)
+                dumped[0] = messages[0].dump
         except Exception as e:
             print(f"Error: {e}")
             continue
@@ -130,47 +203,52 @@ def main(toolfuncs : list[ToolFunctionType]):
         usage = []
         def clog(log: CompletionLog):
             usage.append(log.usage)
-            with open("completion.log", "a") as f:
-                f.write(str(log.model_dump_json(indent=2)) + "\n")
-        
-        # Pick the correct toolchat implementation based on current model
-        toolchat_impl = choose_toolchat_impl(model)
+            log_file.write(log.to_json())   # compact, pretty print offline with python -m json.tool if needed
+            log_file.write("\n")
             
         async def run_toolchat():
-            current_assistant_message = ""
+            assistant_parts: list[str] = []   # joined into the assistant message once the stream is done
             
             # Prepare kwargs for toolchat
             toolchat_kwargs = {
-                "messages": [m.model_dump() for m in messages],
+                "messages": list(dumped),   # shallow copy as the toolchats modify the list
                 "tools": toolfuncs,
                 "model": model,
                 "log_func": clog
             }
             
             # Add thinking_budget for Claude models
-            if "claude" in model.lower() and thinking_budget > 0:
+            if is_claude and thinking_budget > 0:
                 toolchat_kwargs["thinking_budget"] = thinking_budget
                 
-            async for txt in toolchat_impl(**toolchat_kwargs):
-                if isinstance(txt, ToolMessage):
-                    txt = f"\033[35m→  {txt}\033[0m\n"  # Purple color for tool messages
-                    current_assistant_message += txt  # store this for reference
-                elif isinstance(txt, ThinkingMessage):
-                    txt = f"\033[34m{txt}\033[0m"  # Deep blue color for thinking messages
-                    # dont store this in the assistant message
-                else:
-                    current_assistant_message += txt  # store normal assistant output in message history
-                sys.stdout.write(txt)
-                sys.stdout.flush()
+            sink = TokenSink()
+            try:
+                async for txt in toolchat_impl(**toolchat_kwargs):
+                    if isinstance(txt, ToolMessage):
+                        txt = f"\033[35m→  {txt}\033[0m\n"  # Purple color for tool messages
+                        assistant_parts.append(txt)  # store this for reference
+                    elif isinstance(txt, ThinkingMessage):
+                        txt = f"\033[34m{txt}\033[0m"  # Deep blue color for thinking messages
+                        # dont store this in the assistant message
+                    else:
+                        assistant_parts.append(txt)  # store normal assistant output in message history
+                    sink.write(txt)
+            finally:
+                sink.flush()
                 
 
-            messages.append(AssistantMessage(current_assistant_message))
+            assistant_message = ChatCompletionMessage.assistant("".join(assistant_parts))
+            messages.append(assistant_message)
+            dumped.append(assistant_message.dump)
 
-        asyncio.run(run_toolchat())
+        await run_toolchat()
 
-        calls = len(usage)
-        prompt_tokens = sum(u.prompt_tokens for u in usage)
-        completion_tokens = sum(u.completion_tokens for u in usage)
+        calls = prompt_tokens = completion_tokens = 0
+        for u in usage:
+            calls += 1
+            if u:   # a completion that failed before reporting usage has none
+                prompt_tokens += u.prompt_tokens
+                completion_tokens += u.completion_tokens
         cost_val = ai_pricing.cost(model, prompt_tokens, completion_tokens)
         session_cost += cost_val
 
@@ -187,9 +265,15 @@ def main(toolfuncs : list[ToolFunctionType]):
 if __name__ == "__main__":
     from tool_exec import exec
     from tool_psql import psql
-    from tool_pdf_to_text import pdf_to_text
+    from tool_pdf_to_text import pdf_to_text, close_session
     
     toolfuncs = [exec, psql, pdf_to_text]
     for tool in toolfuncs:
         print_formatted_text(FormattedText([("fg:violet", "Available tool: " + tool.__name__)]))
-    main(toolfuncs)
+
+    async def run():
+        try:
+            await main(toolfuncs)
+        finally:
+            await close_session()   # the pdf download session is shared across tool calls
+    asyncio.run(run())
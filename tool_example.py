@@ -1,7 +1,8 @@
 # an example tool that can be used as a template to create new tools
 from pydantic import Field # for defining the parameters
 import asyncio  # tools must be async to work in out framework
-from ai_toolchat import BaseToolParam, ToolMessage
+import subprocess
+from ai_toolchat import BaseToolParam, ToolMessage, tool
 from loguru import logger
 from typing import Optional
 
@@ -12,7 +13,8 @@ class ExampleParam(BaseToolParam):
     input: str = Field(..., description="The input to the tool.")
     debug: Optional[str] = Field(..., description="anything for debug")
     
-# define the tool function
+# define the tool function, @tool builds its toolspec once at import time
+@tool
 async def example(param: ExampleParam):
     """
     [Document here the purpose of the tool function and when it should be used.}
@@ -27,10 +29,9 @@ async def example(param: ExampleParam):
 
     cmd = ['echo', str(param.input)]
 
-    process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,  stderr=asyncio.subprocess.PIPE)                    
-
-    # Wait for the subprocess to finish and capture the output
-    stdout, stderr = await process.communicate()
+    # short lived commands run in a worker thread so the event loop is free for other tool calls
+    process = await asyncio.to_thread(subprocess.run, cmd, capture_output=True)
+    stdout, stderr = process.stdout, process.stderr
 
     stdout = stdout.decode() if stdout else ""
     stderr = stderr.decode() if stderr else ""
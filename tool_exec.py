@@ -1,10 +1,14 @@
 from pydantic import Field
-from ai_toolchat import BaseToolParam, ToolMessage
+from ai_toolchat import BaseToolParam, ToolMessage, tool
 import asyncio
+import codecs
+
+READ_CHUNK_BYTES = 64 * 1024   # size of the stdout reads yielded to the caller
 
 class ExecParam(BaseToolParam):
     command: str = Field(..., description="The command to execute.")
 
+@tool(reentrant=False)   # calls in one round run in order, later commands may depend on earlier ones
 async def exec(param: ExecParam):
     """Run a command line tool on behalf of the user."""
 
@@ -14,15 +18,31 @@ async def exec(param: ExecParam):
         param.command,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
-        limit=128*1024*4
     )
-    
-    # Wait for the subprocess to finish and capture the output
-    stdout, stderr = await process.communicate()
+
+    # stderr is drained concurrently so a chatty command can't block on a full stderr pipe
+    stderr_task = asyncio.create_task(process.stderr.read())
+
+    try:
+        # stream stdout as it arrives rather than buffering the whole output,
+        # the incremental decoder keeps multi-byte characters split across chunks intact
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while chunk := await process.stdout.read(READ_CHUNK_BYTES):
+            if text := decoder.decode(chunk):
+                yield text
+        if text := decoder.decode(b"", final=True):
+            yield text
+
+        stderr = await stderr_task
+        await process.wait()
+    finally:
+        # the tool call was cancelled or closed early, don't leave the command running
+        stderr_task.cancel()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
 
     if process.returncode != 0:
         # If the process did not exit successfully, log the error
-        raise ValueError(f"Error executing command: {stderr.decode()}")
-
-    yield stdout.decode()
+        raise ValueError(f"Error executing command: {stderr.decode(errors='replace')}")
 
@@ -2,34 +2,95 @@ from pydantic import Field, HttpUrl
 import asyncio
 import aiohttp
 from io import BytesIO
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
 from pdfminer.high_level import extract_pages
 from pdfminer.layout import LTTextContainer
-from ai_toolchat import BaseToolParam, ToolMessage
+from ai_toolchat import BaseToolParam, ToolMessage, tool
 from loguru import logger
 
 # Define a pydantic model based on BaseToolParam to define the parameters for the tool
 class PDFToTextParam(BaseToolParam):
     url: str = Field(description="The URL of the PDF to convert to text.")
 
+# pdfminer extraction is CPU bound so it runs off the event loop: in a thread, or for large PDFs
+# in a small process pool so the pure python layout analysis isn't serialized by the GIL
+PROCESS_POOL_MIN_BYTES = 10 * 1024 * 1024
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+
+def get_pdf_pool() -> ProcessPoolExecutor:
+    """
+    Return the process pool for extracting large PDFs, created on first use.
+    The workers come from a forkserver as forking this multi-threaded process can deadlock.
+    """
+    global _pdf_pool
+    if _pdf_pool is None:
+        _pdf_pool = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("forkserver"))
+    return _pdf_pool
+
+def reset_pdf_pool():
+    """
+    Drop the process pool after a worker died (e.g. pdfminer crashed or was OOM killed),
+    a broken pool rejects all further work so the next large PDF gets a fresh one.
+    """
+    global _pdf_pool
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(wait=False, cancel_futures=True)
+        _pdf_pool = None
+
+# one download session shared across calls so connections (and TLS sessions) to a host are reused
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+async def get_session() -> aiohttp.ClientSession:
+    """
+    Return the shared download session, created on first use
+    (or again if it was closed or belongs to a different event loop).
+    """
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    session = _session
+    if session is None or session.closed or _session_loop is not loop:
+        old = session
+        session = _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300))
+        _session_loop = loop
+        if old is not None and not old.closed:
+            # left over from an earlier event loop, close its pooled connections rather than leak them
+            try:
+                await old.close()
+            except Exception as e:
+                logger.warning(f"Could not close the previous download session: {e}")
+                old.detach()
+    return session
+
+async def close_session():
+    """
+    Close the shared download session, call this before the event loop shuts down.
+    """
+    if _session is not None and not _session.closed:
+        await _session.close()
+
 # Function to extract text from PDF bytes using pdfminer
 def pdf_to_text_via_pdfminer(pdf_bytes: bytes) -> str:
     """
     Extract text from the pdf_bytes and return it as a single string.
     """
-    text = ""
-    pagecount = 0
+    lines = []   # joined once at the end rather than growing a string line by line
     
     for page_layout in extract_pages(BytesIO(pdf_bytes)):
         for element in page_layout:
             if isinstance(element, LTTextContainer):
                 for text_line in element:
-                    line = text_line.get_text().rstrip() + "\n"
-                    text += line    
+                    lines.append(text_line.get_text().rstrip())
+                    lines.append("\n")
     # Remove null characters which sometimes occur but the db doesn't like
-    text = text.replace('\x00', '')                    
+    text = "".join(lines).replace('\x00', '')                    
     return text
 
 # Define the tool function
+@tool
 async def pdf_to_text(param: PDFToTextParam):
     """
     This tool downloads a PDF from the provided URL and converts it to text using pdfminer.
@@ -38,19 +99,28 @@ async def pdf_to_text(param: PDFToTextParam):
     yield ToolMessage(f"Downloading PDF from {param.url}...")
 
     # Download the PDF file
-    async with aiohttp.ClientSession() as session:
-        async with session.get(param.url) as response:
-            if response.status != 200:
-                err = f"Failed to download PDF from {param.url}. HTTP status: {response.status}"
-                logger.warning(err)
-                raise ValueError(err)
-            pdf_bytes = await response.read()
+    session = await get_session()
+    async with session.get(param.url) as response:
+        if response.status != 200:
+            err = f"Failed to download PDF from {param.url}. HTTP status: {response.status}"
+            logger.warning(err)
+            raise ValueError(err)
+        pdf_bytes = await response.read()
 
     yield ToolMessage(f"Converting PDF to text...")
 
     # Convert the PDF bytes to text
     try:
-        text = pdf_to_text_via_pdfminer(pdf_bytes)
+        if len(pdf_bytes) >= PROCESS_POOL_MIN_BYTES:
+            loop = asyncio.get_running_loop()
+            text = await loop.run_in_executor(get_pdf_pool(), pdf_to_text_via_pdfminer, pdf_bytes)
+        else:
+            text = await asyncio.to_thread(pdf_to_text_via_pdfminer, pdf_bytes)
+    except BrokenProcessPool as e:
+        reset_pdf_pool()
+        err = f"Error converting PDF to text, the extraction process died: {str(e)}"
+        logger.error(err)
+        raise ValueError(err)
     except Exception as e:
         err = f"Error converting PDF to text: {str(e)}"
         logger.error(err)
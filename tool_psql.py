@@ -1,13 +1,15 @@
 from pydantic import Field
-from ai_toolchat import BaseToolParam, ToolMessage
+from ai_toolchat import BaseToolParam, ToolMessage, tool
 from loguru import logger
 import os
 import asyncio
+import subprocess
 
 class PsqlParam(BaseToolParam):
     psql_args: list[str] = Field(description="The command line args to psql.")
 
     
+@tool(reentrant=False)   # calls in one round run in order, later commands may depend on earlier ones
 async def psql(param: PsqlParam):
     """
     This tool invokes the 'psql' command command line with the specified args on the command line. 
@@ -27,33 +29,28 @@ async def psql(param: PsqlParam):
         param.psql_args = param.psql_args[1:]
         
     cmd =  ['psql'] + param.psql_args
+    cmdstr = " ".join(cmd)
 
-    yield ToolMessage(f"Executing:  {' '.join(cmd)}")
+    yield ToolMessage(f"Executing:  {cmdstr}")
     
-    # execute the psql command and return the output
-    process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-
-    # Wait for the subprocess to finish and capture the output
-    stdout, stderr = await process.communicate()
+    # execute the psql command in a worker thread, spawn and wait happen off the event loop
+    # so other tool calls keep running while psql does
+    process = await asyncio.to_thread(subprocess.run, cmd, capture_output=True)
+    stdout, stderr = process.stdout, process.stderr
 
     stdout = stdout.decode() if stdout else ""
     stderr = stderr.decode() if stderr else ""
 
-    # Check the return code to determine if the command was successful
-    if process.returncode != 0:
-        # Raise a ValueError if the tool encounters an error
-        raise ValueError(f"Error executing psql command: {stderr}")
-    
     # check return code
     if process.returncode != 0:
         # raise a ValueError if the tool encounters an error.  
         # provide helpful content in the error message.  
         # this will be returned to the LLM model that called the tool
-        err = f"Error executing command {cmd}:\n{stdout}\n{stderr}"
+        err = f"Error executing command '{cmdstr}':\n{stdout}\n{stderr}"
         logger.warning(err)
         raise ValueError(err)
 
-    linecount = len(stdout.split("\n"))
+    linecount = stdout.count("\n") + 1   # counted in place, no list of lines
     yield ToolMessage(f"Reading {linecount} lines of psql output.")
     
     # Yield the output of the tool, which will be returned to the LLM model for subsequent processing